@@ -0,0 +1,2 @@
+# Pipeline identifying user navigation archetypes in the Gallica logs.
+# The stages are imported on demand (see cli.py), so importing the package stays cheap.
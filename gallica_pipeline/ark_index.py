@@ -0,0 +1,191 @@
+# %%
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from .config import ARK_INDEX
+
+# %% [markdown]
+# ## Columnar index of the documents
+#
+# Per-document questions (how often is an Ark accessed, paginated or downloaded, in which sessions) would
+# otherwise scan every session. The index is built once by collate.py and made of two parquet files:
+# - postings: one row per run of consecutive actions on the same Ark within a session, with the session
+#   partition it comes from, its row range in that partition and the counts of actions of the run
+# - documents: one row per Ark, sorted, with the counts of the document and the range of its postings
+#
+# The postings are sorted by Ark as well, so a lookup is a binary search in the Ark column of the
+# documents followed by the read of the few row groups holding its postings. The actions of a document are
+# read the same way, from the row groups of the session partitions holding its row ranges. Row ranges refer to the
+# session partitions and not to the collated file, so adding partitions never shifts them: only the
+# new or rewritten partitions are scanned and the postings of the others are kept as they are.
+
+# %%
+ACCESS_ACTIONS = ["document_access", "revisit_document"]
+PAGINATION_ACTIONS = ["first_page", "next_page", "prev_page", "chosen_page"]
+DOWNLOAD_ACTIONS = ["document_download", "page_download"]
+COUNT_COLUMNS = ["actions", "accesses", "pagination_moves", "downloads"]
+
+POSTINGS_FILE = "postings.parquet"
+DOCUMENTS_FILE = "documents.parquet"
+PARTITIONS_FILE = "partitions.json"
+# small row groups keep the read of the postings of a single Ark short
+POSTINGS_ROW_GROUP_SIZE = 2 ** 16
+
+
+def partition_fingerprint(path):
+    # a session partition is rewritten when its chunk is formed again
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def index_partition(path):
+    # postings of a session partition
+    df = pd.read_parquet(path, columns=["session_id", "action", "Ark"])
+    df["row"] = np.arange(len(df))
+    # a run ends when the session or the document changes
+    new_run = (df["session_id"] != df["session_id"].shift()) | (df["Ark"] != df["Ark"].shift())
+    df["run"] = new_run.cumsum()
+    df = df[df["Ark"].notna()]
+
+    df["actions"] = 1
+    df["accesses"] = df["action"].isin(ACCESS_ACTIONS).astype(int)
+    df["pagination_moves"] = df["action"].isin(PAGINATION_ACTIONS).astype(int)
+    df["downloads"] = df["action"].isin(DOWNLOAD_ACTIONS).astype(int)
+
+    runs = df.groupby("run", sort=False)
+    postings = runs[["Ark", "session_id"]].first()
+    postings["partition"] = path
+    postings["row_start"] = runs["row"].min()
+    postings["row_stop"] = runs["row"].max() + 1
+    postings[COUNT_COLUMNS] = runs[COUNT_COLUMNS].sum()
+    return postings.reset_index(drop=True)
+
+
+def summarize_postings(postings):
+    # counts of every document, postings being sorted by Ark
+    documents = postings.groupby("Ark").agg(
+        actions=("actions", "sum"),
+        accesses=("accesses", "sum"),
+        pagination_moves=("pagination_moves", "sum"),
+        downloads=("downloads", "sum"),
+        distinct_sessions=("session_id", "nunique"),
+        number_of_postings=("session_id", "size"))
+    documents["postings_stop"] = documents["number_of_postings"].cumsum()
+    documents["postings_start"] = documents["postings_stop"] - documents["number_of_postings"]
+    return documents.drop(columns="number_of_postings").reset_index()
+
+
+def row_group_offsets(parquet_file):
+    # position of the first row of every row group, followed by the number of rows
+    sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+    return np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+
+def read_rows(parquet_file, offsets, starts, stops):
+    # read the rows of the ranges [start, stop) from the row groups holding them only
+    positions = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+    row_groups = np.unique(np.searchsorted(offsets, positions, side="right") - 1)
+    df = parquet_file.read_row_groups(row_groups.tolist()).to_pandas()
+    # index the rows by their position in the file
+    df.index = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in row_groups])
+    return df.loc[positions]
+
+
+def write_parquet(df, path, **kwargs):
+    # write to a temporary file first so an interrupted update never leaves a broken index
+    df.to_parquet(path + ".tmp", engine="pyarrow", index=False, compression="snappy", **kwargs)
+    os.replace(path + ".tmp", path)
+
+
+def load_indexed_partitions(index_path=ARK_INDEX):
+    path = os.path.join(index_path, PARTITIONS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as partitions_file:
+        return json.load(partitions_file)
+
+
+def update_ark_index(sessions_file_list, index_path=ARK_INDEX):
+    os.makedirs(index_path, exist_ok=True)
+    indexed = load_indexed_partitions(index_path)
+    fingerprints = {path: partition_fingerprint(path) for path in sessions_file_list}
+    # partitions that are new or were rewritten since the last update
+    changed = [path for path in sessions_file_list if indexed.get(path) != fingerprints[path]]
+    removed = [path for path in indexed if path not in fingerprints]
+    if not changed and not removed:
+        return
+    print(f"Indexing {len(changed)} session partitions")
+
+    kept = []
+    postings_path = os.path.join(index_path, POSTINGS_FILE)
+    if os.path.exists(postings_path):
+        postings = pd.read_parquet(postings_path)
+        postings["partition"] = postings["partition"].astype(str)
+        kept.append(postings[~postings["partition"].isin(changed + removed)])
+    postings = pd.concat(kept + [index_partition(path) for path in changed], ignore_index=True)
+    postings = postings.sort_values(["Ark", "partition", "row_start"], ignore_index=True)
+    documents = summarize_postings(postings)
+
+    # the partition column only holds a few distinct paths
+    postings["partition"] = postings["partition"].astype("category")
+    write_parquet(postings, postings_path, row_group_size=POSTINGS_ROW_GROUP_SIZE)
+    write_parquet(documents, os.path.join(index_path, DOCUMENTS_FILE))
+    # the partitions are recorded last, an interrupted update is redone from scratch for them
+    with open(os.path.join(index_path, PARTITIONS_FILE + ".tmp"), "w") as partitions_file:
+        json.dump(fingerprints, partitions_file, indent=1, sort_keys=True)
+    os.replace(os.path.join(index_path, PARTITIONS_FILE + ".tmp"), os.path.join(index_path, PARTITIONS_FILE))
+    print(f"Indexed {len(documents)} documents")
+
+
+# %% [markdown]
+# ## Lookups
+
+# %%
+class ArkIndex:
+    def __init__(self, index_path=ARK_INDEX):
+        self.documents = pd.read_parquet(os.path.join(index_path, DOCUMENTS_FILE))
+        # fixed width strings so the binary search does not compare python objects
+        self.arks = self.documents["Ark"].to_numpy().astype(str)
+        self.postings_file = pq.ParquetFile(os.path.join(index_path, POSTINGS_FILE))
+        self.postings_offsets = row_group_offsets(self.postings_file)
+
+    def __len__(self):
+        return len(self.arks)
+
+    def __contains__(self, ark):
+        position = np.searchsorted(self.arks, ark)
+        return position < len(self.arks) and self.arks[position] == ark
+
+    def position(self, ark):
+        position = np.searchsorted(self.arks, ark)
+        if position == len(self.arks) or self.arks[position] != ark:
+            raise KeyError(ark)
+        return position
+
+    def counts(self, ark):
+        # actions, accesses, pagination moves, downloads and distinct sessions of the document
+        return self.documents.iloc[self.position(ark)]
+
+    def postings(self, ark):
+        document = self.counts(ark)
+        postings = read_rows(self.postings_file, self.postings_offsets,
+                             [document["postings_start"]], [document["postings_stop"]])
+        postings["partition"] = postings["partition"].astype(str)
+        return postings.reset_index(drop=True)
+
+    def sessions(self, ark):
+        return self.postings(ark)["session_id"].unique()
+
+    def rows(self, ark):
+        # actions of the sessions on the document, read from the row groups of the session partitions
+        # holding them (session files written before SESSIONS_ROW_GROUP_SIZE are a single row group)
+        partitions, rows = [], []
+        for partition, postings in self.postings(ark).groupby("partition", sort=False):
+            parquet_file = pq.ParquetFile(partition)
+            partitions.append(partition)
+            rows.append(read_rows(parquet_file, row_group_offsets(parquet_file),
+                                  postings["row_start"], postings["row_stop"]))
+        # index the rows by their session partition and their position in it
+        return pd.concat(rows, keys=partitions, names=["partition", "row"])
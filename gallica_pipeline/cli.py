@@ -0,0 +1,157 @@
+import argparse
+import os
+
+# %% [markdown]
+# ## Command line
+#
+# `python -m gallica_pipeline <command>`. Nothing heavy is imported at module level: every command
+# imports the stage it runs, so `--help` and `status` do not pay for pandas, dask or the notebooks.
+
+# %%
+def ingest(args):
+    from .config import SERVER, USERNAME, PASSWORD, NAS_PATH
+    from .ingest import ingest
+    ingest(server=args.server or SERVER, username=args.username or USERNAME,
+           password=args.password or PASSWORD, path=args.path or NAS_PATH)
+
+
+def process(args):
+    from .config import WRITE_MODE, COOCCURRENCE, SPILL_DIR, chunk_indices
+    from .process import process_chunk, process_all
+    # the options left out fall back to config.py, as in `run`
+    options = dict(write_mode=args.write_mode or WRITE_MODE,
+                   cooccurrence=COOCCURRENCE if args.cooccurrence is None else args.cooccurrence,
+                   spill_dir=args.spill_dir or SPILL_DIR)
+    if args.chunk is None:
+        process_all(**options)
+    else:
+        files_start_indices, files_stop_indices = chunk_indices()
+        process_chunk(files_start_indices[args.chunk - 1], files_stop_indices[args.chunk - 1], args.chunk, **options)
+
+
+def sessionize(args):
+    from . import config
+    from .dag import incremental_sessions
+    from .sessionize import form_sessions, form_all_sessions, update_all_sessions
+    if args.incremental:
+        update_all_sessions()
+    elif incremental_sessions():
+        # forming the sessions from scratch would overwrite the partitions the tail state points past
+        print(f"the sessions are updated incrementally: use --incremental, "
+              f"or remove {config.SESSIONS_STATE} to form them from scratch")
+    elif args.chunk is None:
+        form_all_sessions()
+    else:
+        form_sessions(args.chunk)
+
+
+def collate(args):
+    from .collate import collate_sessions
+    collate_sessions()
+
+
+def ark(args):
+    from .config import ARK_INDEX
+    from .ark_index import ArkIndex, DOCUMENTS_FILE
+    if not os.path.exists(os.path.join(ARK_INDEX, DOCUMENTS_FILE)):
+        print("no Ark index yet, run collate first")
+        return
+    index = ArkIndex()
+    if args.ark not in index:
+        print(f"{args.ark} is not in the index")
+        return
+    print(index.counts(args.ark).to_string())
+    if args.rows:
+        print(index.rows(args.ark).to_string())
+
+
+def mine(args):
+    from .mine import mine
+    mine(method=args.method, timeout=args.timeout)
+
+
+def run(args):
+    from .dag import run_pipeline
+    run_pipeline(jobs=args.jobs, dry_run=args.dry_run, force_ingest=args.ingest)
+
+
+def status(args):
+    from . import config
+    from .dag import plan, incremental_sessions
+    if not os.path.exists(config.FILES_CSV):
+        print("nothing ingested yet")
+        return
+    tasks, stale = plan()
+    # count the up to date and stale tasks of every stage
+    counts = {}
+    for task in tasks:
+        stage = task.name.split("[")[0]
+        up_to_date, to_rebuild = counts.get(stage, (0, 0))
+        if task.name in stale:
+            counts[stage] = (up_to_date, to_rebuild + 1)
+        else:
+            counts[stage] = (up_to_date + 1, to_rebuild)
+    for stage, (up_to_date, to_rebuild) in counts.items():
+        print(f"{stage}: {up_to_date} up to date, {to_rebuild} to rebuild")
+    if incremental_sessions():
+        print("the sessions are updated incrementally, `run` is disabled")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m gallica_pipeline",
+                                     description="Identify user navigation archetypes in the Gallica logs.")
+    parser.add_argument("--sample", type=float, default=None,
+                        help="keep this fraction of the users in every stage (sets GALLICA_SAMPLE_FRACTION)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="copy the log files from the NAS")
+    command.add_argument("--server")
+    command.add_argument("--username")
+    command.add_argument("--password")
+    command.add_argument("--path", help="directory of the logs on the NAS")
+    command.set_defaults(func=ingest)
+
+    command = commands.add_parser("process", help="parse and classify the requests of every chunk of files")
+    command.add_argument("--chunk", type=int, help="only process this chunk")
+    command.add_argument("--write-mode", choices=["partitioned", "compute"])
+    command.add_argument("--cooccurrence", action=argparse.BooleanOptionalAction, default=None,
+                         help="also save the requests matching several actions")
+    command.add_argument("--spill-dir", help="let dask spill partitions to this directory")
+    command.set_defaults(func=process)
+
+    command = commands.add_parser("sessionize", help="form the user sessions of every processed chunk")
+    command.add_argument("--chunk", type=int, help="only form the sessions of this chunk")
+    command.add_argument("--incremental", action="store_true",
+                         help="extend the sessions left open by the previous run with the new chunks")
+    command.set_defaults(func=sessionize)
+
+    command = commands.add_parser("collate", help="join the sessions into a single file and update the Ark index")
+    command.set_defaults(func=collate)
+
+    command = commands.add_parser("ark", help="show the counts and sessions of a document from the Ark index")
+    command.add_argument("ark")
+    command.add_argument("--rows", action="store_true", help="also show the actions of the sessions on the document")
+    command.set_defaults(func=ark)
+
+    command = commands.add_parser("mine", help="run the sequence mining and clustering notebook")
+    command.add_argument("--method", choices=["spm", "sgt"], default="spm")
+    command.add_argument("--timeout", type=int, default=None, help="timeout of a cell in seconds")
+    command.set_defaults(func=mine)
+
+    command = commands.add_parser("run", help="run the whole pipeline, rebuilding only invalidated outputs")
+    command.add_argument("--jobs", type=int, default=2, help="number of tasks run in parallel")
+    command.add_argument("--dry-run", action="store_true", help="only show what would be rebuilt")
+    command.add_argument("--ingest", action="store_true", help="download the log files again")
+    command.set_defaults(func=run)
+
+    command = commands.add_parser("status", help="count the up to date and stale outputs of every stage")
+    command.set_defaults(func=status)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # the configuration reads the fraction when it is first imported, and worker processes inherit it
+    if args.sample is not None:
+        os.environ["GALLICA_SAMPLE_FRACTION"] = str(args.sample)
+    args.func(args)
@@ -0,0 +1,21 @@
+import glob
+import re
+import pandas as pd
+from tqdm import tqdm
+from .config import SESSIONS_PARQUET, SESSIONS_FULL
+from .ark_index import update_ark_index
+
+
+def collate_sessions(sessions_file_list=None):
+    if sessions_file_list is None:
+        sessions_file_list = glob.glob(SESSIONS_PARQUET + '/*.parquet')
+    # a session continued by an incremental update spans several partitions, join them in chunk order
+    # so the actions of every session stay in order
+    sessions_file_list = sorted(sessions_file_list, key=lambda file: int(re.search(r"(\d+)\.parquet$", file).group(1)))
+
+    sessions_df = pd.concat([pd.read_parquet(file) for file in tqdm(sessions_file_list)])
+
+    sessions_df.to_parquet(SESSIONS_FULL)
+
+    # only the partitions added or rewritten since the last collation are indexed
+    update_ark_index(sessions_file_list)
@@ -0,0 +1,89 @@
+# %%
+import os
+
+# %% [markdown]
+# ## Parameters of the pipeline
+#
+# This module only holds constants and depends on nothing but the standard library, so the command line,
+# the DAG runner and the worker processes can read the parameters without loading pandas or dask.
+
+# %%
+# smb connection to the lab NAS (replace with your actual credentials)
+SERVER = "<server>"
+USERNAME = "<username>"
+PASSWORD = "<password>"
+NAS_PATH = "<path>"
+# directory where the log files are copied
+LOCAL_PATH = r"Data"
+
+# %%
+# parameters of the processing of the chunks
+PATTERN = r'^\[(?P<timestamp>.*?)\]\s+"(?P<request_type>\w+)\s+(?P<endpoint>.*?)\s+(?P<http_version>HTTP/\d\.\d)+"\s+(?P<status_code>\d+)?\s*(?P<content_length>\d+|\-)?\s+"(?P<referrer>.*?)"\s+"(?P<user_agent>.*?)"?\"?\s*(?P<response_time>\d+)?$'
+# number of files to be processed (should be between 1 and 22637)
+TOTAL_NUMBER_OF_FILES = 6575
+CHUNK_SIZE = 20
+
+if TOTAL_NUMBER_OF_FILES == 'max':
+    TOTAL_NUMBER_OF_FILES = 6575
+
+# file numbers that are never processed
+SKIPPED_FILE_NUMBERS = [1300, 1301]
+# "partitioned" writes the dask partitions straight to a parquet dataset, "compute" collects the chunk in memory first
+WRITE_MODE = "partitioned"
+# write the requests matching more than one action to COOCCURRENCE_PARQUET (diagnostics only)
+COOCCURRENCE = False
+# directory where dask spills partitions that do not fit in memory (None disables spilling)
+SPILL_DIR = None
+# a gzip log file is roughly this many times larger once loaded as a pandas dataframe
+MEMORY_EXPANSION = 10
+# fraction of the available memory a single partition may use per thread
+PARTITION_MEMORY_FRACTION = 0.25
+
+# %%
+# parameters of the sessions
+INACTIVE_THRESHOLD = 60
+REQUEST_THRESHOLD = 1
+IS_BOT = 0
+
+# only the rows of the previous chunk that are at most this many seconds older than the chunk are compared
+DEDUP_WINDOW = 300
+# rows per row group of the session files, the Ark index reads only the row groups holding a document
+SESSIONS_ROW_GROUP_SIZE = 2 ** 16
+
+# %%
+# fraction of the users kept by every stage (1 keeps everyone), see sampling.py
+SAMPLE_FRACTION = float(os.environ.get("GALLICA_SAMPLE_FRACTION", 1))
+# salt of the user hash, changing it draws a different sample of the same size
+SAMPLE_SALT = os.environ.get("GALLICA_SAMPLE_SALT", "gallica-sessions")
+SAMPLE_BUCKETS = 10000
+
+
+def data_path(path, fraction=None):
+    # outputs of a sampled run live next to the full ones, e.g. temp_data/sample_0.01/processed_parquet
+    fraction = SAMPLE_FRACTION if fraction is None else fraction
+    if fraction >= 1:
+        return path
+    root, _, rest = path.partition("/")
+    return f"{root}/sample_{fraction:g}/{rest}"
+
+
+def chunk_indices():
+    # start and stop indices (in the list of files) of every chunk, chunk n being at position n - 1
+    files_start_indices = list(range(0, TOTAL_NUMBER_OF_FILES, CHUNK_SIZE))
+    files_stop_indices = list(range(CHUNK_SIZE, TOTAL_NUMBER_OF_FILES, CHUNK_SIZE))
+    files_stop_indices.append(TOTAL_NUMBER_OF_FILES - 1)
+    return files_start_indices, files_stop_indices
+
+
+# %%
+# paths (the list of files is shared by all runs, the other outputs are stored apart in sampling mode)
+FILES_CSV = "temp_data/files.csv"
+MANIFEST_PATH = "temp_data/.cache/manifest.json"
+PROCESSED_PARQUET = data_path("temp_data/processed_parquet")
+PROCESSED_INPUTS = data_path("temp_data/processed_inputs")
+COOCCURRENCE_PARQUET = data_path("temp_data/cooccurrence_parquet")
+SESSIONS_PARQUET = data_path("temp_data/sessions_parquet")
+SESSIONS_FULL = data_path("temp_data/sessions_full.parquet")
+ARK_INDEX = data_path("temp_data/ark_index")
+DEDUP_STATS = data_path("temp_data/dedup_stats")
+SESSIONS_STATE = data_path("temp_data/sessions_state")
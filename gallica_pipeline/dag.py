@@ -0,0 +1,257 @@
+# %%
+import csv
+import hashlib
+import importlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+
+from . import config
+
+# %% [markdown]
+# ## Content-hash cached stage DAG
+#
+# The pipeline is modelled as a DAG of tasks: ingest -> process[n] -> sessionize[n] -> collate.
+# Every task has a key computed from the fingerprint of its inputs, its parameters and the source
+# code of the module that implements the stage. The key of an output is stored in a manifest
+# once the task succeeds, so a task is only rerun when its key changes or its output is missing.
+# Planning only needs the standard library: the stage modules (and pandas or dask) are imported
+# by the worker processes that run the tasks.
+
+# %%
+@dataclass
+class Task:
+    name: str
+    # "<module>:<function>" of the stage, relative to the package
+    target: str
+    args: tuple
+    output: str
+    key: str
+    deps: list = field(default_factory=list)
+
+
+def hash_values(*values):
+    # hash any json serializable values into a short hex digest
+    payload = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def code_version(module_name):
+    # the version of a stage is the hash of the source code of its module, read without importing it
+    path = os.path.join(os.path.dirname(__file__), module_name + ".py")
+    with open(path) as module_file:
+        return hash_values(module_file.read())
+
+
+def file_fingerprint(path):
+    # the raw log files never change once copied, so size and modification time identify their content
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def chunk_inputs(file_paths):
+    # identify the files of a chunk, so a chunk completed by new files is told apart from the partial one
+    return [file_fingerprint(path) for path in file_paths]
+
+
+def save_chunk_inputs(file_number, file_paths):
+    # one file per chunk, so the chunks processed in parallel do not write the same file
+    os.makedirs(config.PROCESSED_INPUTS, exist_ok=True)
+    with open(os.path.join(config.PROCESSED_INPUTS, f"{file_number}.json"), "w") as inputs_file:
+        json.dump(chunk_inputs(file_paths), inputs_file)
+
+
+def load_chunk_inputs(file_number):
+    # inputs of the processed chunk, None if it was never processed
+    path = os.path.join(config.PROCESSED_INPUTS, f"{file_number}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as inputs_file:
+        return json.load(inputs_file)
+
+
+# key recorded for the sessions formed by `sessionize --incremental`, which no task key matches
+INCREMENTAL_KEY = "incremental"
+
+
+def incremental_sessions():
+    # the sessions are updated incrementally once a tail state exists (see sessionize.py)
+    return os.path.exists(os.path.join(config.SESSIONS_STATE, "state.json"))
+
+
+def load_manifest():
+    if not os.path.exists(config.MANIFEST_PATH):
+        return {}
+    with open(config.MANIFEST_PATH) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(config.MANIFEST_PATH), exist_ok=True)
+    # write to a temporary file first so an interrupted run never leaves a broken manifest
+    with open(config.MANIFEST_PATH + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(config.MANIFEST_PATH + ".tmp", config.MANIFEST_PATH)
+
+
+def run_task(target, args):
+    # executed in a worker process: only the module of the stage is imported
+    module_name, function_name = target.split(":")
+    module = importlib.import_module("." + module_name, __package__)
+    return getattr(module, function_name)(*args)
+
+
+# %% [markdown]
+# ## Building the DAG
+
+# %%
+def build_tasks():
+    with open(config.FILES_CSV, newline="") as files_csv:
+        local_paths = [row["local_path"] for row in csv.DictReader(files_csv)]
+    files_start_indices, files_stop_indices = config.chunk_indices()
+
+    # the deduplication helpers and the sampling rule are shared by both stages
+    shared_version = hash_values(code_version("dedup"), code_version("sampling"))
+    process_version = hash_values(code_version("process"), shared_version)
+    sessionize_version = hash_values(code_version("sessionize"), shared_version)
+    collate_version = hash_values(code_version("collate"), code_version("ark_index"))
+    process_params = [config.PATTERN, config.WRITE_MODE, config.COOCCURRENCE,
+                      config.SAMPLE_FRACTION, config.SAMPLE_SALT]
+    sessionize_params = [config.INACTIVE_THRESHOLD, config.REQUEST_THRESHOLD, config.IS_BOT, config.DEDUP_WINDOW]
+
+    tasks = []
+    session_tasks = []
+    previous_process_task = None
+    for file_number in range(1, len(files_start_indices) + 1):
+        if file_number in config.SKIPPED_FILE_NUMBERS:
+            previous_process_task = None
+            continue
+        start_index = files_start_indices[file_number - 1]
+        stop_index = files_stop_indices[file_number - 1]
+        # chunks that point past the end of the file list have nothing to process
+        if start_index >= len(local_paths):
+            break
+        inputs = chunk_inputs(local_paths[start_index:stop_index])
+
+        process_task = Task(
+            name=f"process[{file_number}]",
+            target="process:process_chunk",
+            args=(start_index, stop_index, file_number),
+            output=f"{config.PROCESSED_PARQUET}/{file_number}.parquet",
+            key=hash_values(inputs, process_params, process_version))
+        # the sessions of a chunk also depend on the end of the previous chunk, used to drop duplicates
+        previous_tasks = [process_task] if previous_process_task is None else [process_task, previous_process_task]
+        session_task = Task(
+            name=f"sessionize[{file_number}]",
+            target="sessionize:form_sessions",
+            args=(file_number,),
+            output=f"{config.SESSIONS_PARQUET}/sessions_{file_number}.parquet",
+            key=hash_values([task.key for task in previous_tasks], sessionize_params, sessionize_version),
+            deps=[task.name for task in previous_tasks])
+        tasks += [process_task, session_task]
+        session_tasks.append(session_task)
+        previous_process_task = process_task
+
+    tasks.append(Task(
+        name="collate",
+        target="collate:collate_sessions",
+        args=([task.output for task in session_tasks],),
+        output=config.SESSIONS_FULL,
+        key=hash_values([task.key for task in session_tasks], collate_version),
+        deps=[task.name for task in session_tasks]))
+    return tasks
+
+
+def invalid_reason(task, manifest):
+    # return why the task has to be rebuilt, or None if its output is up to date
+    if not os.path.exists(task.output):
+        return "missing output"
+    if task.output not in manifest:
+        return "unknown key"
+    if manifest[task.output] == INCREMENTAL_KEY:
+        return "formed incrementally"
+    if manifest[task.output] != task.key:
+        return "inputs, parameters or code changed"
+    return None
+
+
+def plan():
+    # return the tasks of the DAG and, for the stale ones, why they have to be rebuilt
+    tasks = build_tasks()
+    manifest = load_manifest()
+
+    # a task is stale when its own key changed or when one of its dependencies is stale
+    stale = {}
+    for task in tasks:
+        reason = invalid_reason(task, manifest)
+        if reason is None and any(dep in stale for dep in task.deps):
+            reason = "dependency rebuilt"
+        if reason is not None:
+            stale[task.name] = reason
+    return tasks, stale
+
+
+# %% [markdown]
+# ## Running the DAG
+
+# %%
+def run_ingest(force=False, dry_run=False):
+    # the ingest stage lists a remote server, so it only runs when asked to or when nothing was ingested yet
+    if os.path.exists(config.FILES_CSV) and not force:
+        return
+    print("ingest: rebuild")
+    if not dry_run:
+        run_task("ingest:ingest", ())
+
+
+def run_pipeline(jobs=2, dry_run=False, force_ingest=False):
+    run_ingest(force=force_ingest, dry_run=dry_run)
+    if not os.path.exists(config.FILES_CSV):
+        print("nothing ingested yet, the remaining stages cannot be planned")
+        return
+
+    # rebuilding the sessions chunk by chunk would overwrite the partitions the tail state points past
+    if incremental_sessions():
+        print(f"the sessions are updated incrementally: use `sessionize --incremental`, "
+              f"or remove {config.SESSIONS_STATE} to rebuild them with the DAG")
+        return
+
+    tasks, stale = plan()
+    for task in tasks:
+        if task.name in stale:
+            print(f"{task.name}: rebuild ({stale[task.name]})")
+    print(f"{len(stale)} of {len(tasks)} tasks to rebuild")
+    if dry_run or not stale:
+        return
+
+    manifest = load_manifest()
+    pending = [task for task in tasks if task.name in stale]
+    done = {task.name for task in tasks if task.name not in stale}
+    running = {}
+    error = None
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            # submit every task whose dependencies are all built, unless a task failed
+            if error is None:
+                for task in [task for task in pending if all(dep in done for dep in task.deps)]:
+                    pending.remove(task)
+                    running[executor.submit(run_task, task.target, task.args)] = task
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                try:
+                    future.result()
+                except Exception as task_error:
+                    print(f"{task.name}: failed ({task_error!r}), waiting for the running tasks")
+                    error = error or task_error
+                    continue
+                manifest[task.output] = task.key
+                save_manifest(manifest)
+                done.add(task.name)
+                print(f"{task.name}: done")
+    # re-raise the error of the first failed task once the tasks still running are built and recorded
+    if error is not None:
+        raise error
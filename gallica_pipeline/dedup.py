@@ -0,0 +1,71 @@
+# %%
+import json
+import os
+import numpy as np
+import pandas as pd
+from .config import DEDUP_WINDOW, DEDUP_STATS
+
+# %% [markdown]
+# ## Deduplication with compact hashed keys
+#
+# A request is identified by its timestamp and endpoint. Instead of comparing these two strings, every row
+# is reduced to a 64 bit key once, in process.py, and the key is kept in the processed output.
+# Duplicates are then dropped at three levels:
+# - partition: within a dask partition, by sorting the keys (process.py)
+# - chunk: across the partitions of a chunk, on the keys only (sessionize.py)
+# - window: against the end of the previous chunk, since duplicated lines are always close in time
+
+# %%
+KEY_COLUMNS = ["timestamp", "endpoint"]
+
+
+def row_keys(df):
+    # 64 bit key of the columns identifying a request
+    return pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False).to_numpy(dtype="uint64")
+
+
+def drop_partition_duplicates(df):
+    # np.unique sorts the keys and returns the position of the first occurrence of each of them
+    keys = row_keys(df)
+    _, first_positions = np.unique(keys, return_index=True)
+    # restore the original order of the rows
+    first_positions.sort()
+    return df.iloc[first_positions].assign(row_key=keys[first_positions])
+
+
+def drop_chunk_duplicates(df):
+    # the partitions of a chunk were deduplicated separately, compare their keys
+    return df.drop_duplicates(subset="row_key")
+
+
+def drop_window_duplicates(df, previous_df):
+    # drop the rows already present at the end of the previous chunk.
+    # both dataframes need a parsed timestamp column and a row_key column
+    if previous_df is None or len(df) == 0:
+        return df
+    window_start = df["timestamp"].min() - pd.Timedelta(seconds=DEDUP_WINDOW)
+    recent_keys = previous_df.loc[previous_df["timestamp"] >= window_start, "row_key"]
+    return df[~df["row_key"].isin(recent_keys)]
+
+
+def update_dedup_stats(file_number, **dropped):
+    # merge the counters of one level into the stats file of the chunk
+    os.makedirs(DEDUP_STATS, exist_ok=True)
+    path = DEDUP_STATS + "/" + str(file_number) + ".json"
+    stats = {}
+    if os.path.exists(path):
+        with open(path) as stats_file:
+            stats = json.load(stats_file)
+    stats.update({level: int(count) for level, count in dropped.items()})
+    with open(path, "w") as stats_file:
+        json.dump(stats, stats_file)
+    print(f"file {file_number} duplicates dropped: {stats}")
+
+
+def read_dedup_stats():
+    # one row per chunk, one column per level
+    stats = {}
+    for file in os.listdir(DEDUP_STATS):
+        with open(DEDUP_STATS + "/" + file) as stats_file:
+            stats[int(file.split(".")[0])] = json.load(stats_file)
+    return pd.DataFrame.from_dict(stats, orient="index").sort_index()
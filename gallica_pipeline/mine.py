@@ -0,0 +1,29 @@
+# %%
+import os
+import nbformat
+from nbclient import NotebookClient
+
+# %% [markdown]
+# ## Sequence mining and clustering
+#
+# The methods live in the notebooks at the root of the repository. They are executed here with the
+# environment of the command line (e.g. the sampling fraction), and the executed copy is saved next to
+# the other outputs so the original notebook is left untouched.
+
+# %%
+NOTEBOOKS = {
+    "spm": "cluster_spm.ipynb",
+    "sgt": "cluster_sgt.ipynb",
+}
+
+
+def mine(method="spm", output_dir="temp_data", timeout=None):
+    notebook_path = NOTEBOOKS[method]
+    notebook = nbformat.read(notebook_path, as_version=4)
+    # run the cells from the root of the repository, where the notebook reads its data
+    NotebookClient(notebook, timeout=timeout, resources={"metadata": {"path": os.getcwd()}}).execute()
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, notebook_path.replace(".ipynb", "_executed.ipynb"))
+    nbformat.write(notebook, output_path)
+    print(f"executed notebook saved to {output_path}")
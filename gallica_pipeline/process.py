@@ -1,50 +1,54 @@
 # %%
-import multiprocessing
 from functools import lru_cache
 import re
 import pandas as pd
+import numpy as np
 from tqdm import tqdm
-from dataprep.eda import create_report
 from fastuaparser import parse_ua
 import dask.dataframe as dd
-from dask import bag as db
-from dask.diagnostics import ProgressBar, Profiler, ResourceProfiler, CacheProfiler
-from dask.distributed import Client
-from fastuaparser import parse_ua
+from dask.diagnostics import ProgressBar
+import dask
+import psutil
+import shutil
 import os
+from .config import (PATTERN, SAMPLE_FRACTION, WRITE_MODE, COOCCURRENCE, SPILL_DIR, MEMORY_EXPANSION,
+                     PARTITION_MEMORY_FRACTION, SKIPPED_FILE_NUMBERS, FILES_CSV, PROCESSED_PARQUET,
+                     COOCCURRENCE_PARQUET, chunk_indices)
+from .sampling import user_in_sample
+from .dedup import drop_partition_duplicates, update_dedup_stats
+from .dag import chunk_inputs, save_chunk_inputs, load_chunk_inputs
 # deactivating warnings
 import warnings
 
-warnings.filterwarnings("ignore")
+# %% [markdown]
+# ## I. Reading the dataframe
 
-pd.set_option('display.max_columns', None)
-# show full length of strings
-pd.set_option('display.max_colwidth', -1)
+def files_per_partition(file_paths, n_threads=None):
+    # gzip files cannot be split, so a partition holds one or more whole files.
+    # group as many files per partition as the memory available to each thread allows
+    n_threads = n_threads or os.cpu_count()
+    budget = psutil.virtual_memory().available * PARTITION_MEMORY_FRACTION / n_threads
+    # a file is read in full before the users out of the sample are dropped, so sampling does not shrink it
+    largest_file = max(os.path.getsize(file_path) for file_path in file_paths) * MEMORY_EXPANSION
+    # but keep at least one partition per thread, or as many as there are files
+    max_files = len(file_paths) // min(len(file_paths), n_threads)
+    return max(1, min(int(budget // largest_file), max_files))
 
-# %%
-# parameters
-PATTERN = r'^\[(?P<timestamp>.*?)\]\s+"(?P<request_type>\w+)\s+(?P<endpoint>.*?)\s+(?P<http_version>HTTP/\d\.\d)+"\s+(?P<status_code>\d+)?\s*(?P<content_length>\d+|\-)?\s+"(?P<referrer>.*?)"\s+"(?P<user_agent>.*?)"?\"?\s*(?P<response_time>\d+)?$'
-# number of files to be processed (should be between 1 and 22637)
-TOTAL_NUMBER_OF_FILES = 6575
-CHUNK_SIZE = 20
 
-if TOTAL_NUMBER_OF_FILES == 'max':
-    TOTAL_NUMBER_OF_FILES = 6575
+def remove_output(path):
+    # the output of a chunk is a single file in "compute" mode and a directory in "partitioned" mode
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
 
-# %% [markdown]
-# ## I. Reading the dataframe
 
-files_start_indices = list(range(0, TOTAL_NUMBER_OF_FILES, CHUNK_SIZE))
-files_stop_indices = list(range(CHUNK_SIZE, TOTAL_NUMBER_OF_FILES, CHUNK_SIZE))
-files_stop_indices.append(TOTAL_NUMBER_OF_FILES - 1)
+def process_chunk(start_index, stop_index, file_number, write_mode=WRITE_MODE, cooccurrence=COOCCURRENCE, spill_dir=SPILL_DIR):
+    warnings.filterwarnings("ignore")
+    os.makedirs(PROCESSED_PARQUET, exist_ok=True)
 
-# if the path "temp_data/processed_parquet" does not exist, create it
-if not os.path.exists("temp_data/processed_parquet"):
-    os.makedirs("temp_data/processed_parquet")
-    
-def process_chunk(start_index, stop_index, file_number):
     # read the file paths from csv (the first line is the header)
-    df_files = pd.read_csv("temp_data/files.csv")
+    df_files = pd.read_csv(FILES_CSV)
     # restrict the number of files to be processed 
     file_paths = df_files.iloc[start_index:stop_index]['local_path'].tolist()
     # define the columns of the dataframe
@@ -64,6 +68,9 @@ def process_chunk(start_index, stop_index, file_number):
     def read_file(file_path):
         ddf = dd.read_csv(file_path, sep="##", header=None,
                         names=cols, compression="gzip", dtype=column_dtypes)
+        # in sampling mode, drop the users out of the sample as soon as the file is read
+        if SAMPLE_FRACTION < 1:
+            ddf = ddf.loc[ddf["user"].map_partitions(user_in_sample, meta=("user", "bool"))]
         return ddf
 
 
@@ -79,6 +86,11 @@ def process_chunk(start_index, stop_index, file_number):
     with ProgressBar():
         ddf = dd.concat(dfs, axis=0, ignore_index=True)
 
+    # merge neighbouring files into partitions sized after the available memory
+    n_partitions = -(-len(file_paths) // files_per_partition(file_paths))
+    if n_partitions < ddf.npartitions:
+        ddf = ddf.repartition(npartitions=n_partitions)
+
 
 
     # ## II. Cleaning and Extracting features
@@ -116,8 +128,11 @@ def process_chunk(start_index, stop_index, file_number):
         r"12148/(?P<Ark>[a-zA-Z0-9]+)", expand=True)
     # concatenate the two dataframes
     ddf = dd.concat([ddf, ddf_ark], axis=1)
-    # drop duplicates on timestamp and endpoint
-    ddf = ddf.drop_duplicates(subset=["timestamp", "endpoint"])
+    # drop duplicates on timestamp and endpoint within each partition, using a hashed key instead of a shuffle.
+    # the key is kept so duplicates across partitions and chunks are dropped when forming sessions
+    rows_read = ddf.map_partitions(len).sum()
+    ddf = ddf.map_partitions(drop_partition_duplicates, meta=ddf._meta.assign(row_key=np.uint64(0)))
+    rows_deduplicated = ddf.map_partitions(len).sum()
 
 
     # Remove leading slashes from the 'endpoint' column
@@ -217,20 +232,21 @@ def process_chunk(start_index, stop_index, file_number):
     ddf['is_heading'] = ddf['is_heading'].mask(
         (ddf['endpoint_1'] == 'html') & (ddf['endpoint_2'] == 'und'), 1)
 
-    # Create a new column with the sum of all "is_" columns for each row
-    ddf['is_sum'] = ddf[['is_homepage', 'is_document', 'is_iiif', 'is_static_http', 'is_blog', 'is_zoom',
-                        'is_services', 'is_simple_search', 'is_advanced_search', 'is_filtering_search_results', 'is_pagination', 'is_heading', 'is_page_download', 'is_document_download', 'is_mode']].sum(axis=1)
     actions = ['is_homepage', 'is_document', 'is_blog', 'is_simple_search', 'is_advanced_search', 'is_filtering_search_results', 'is_page_download', 'is_document_download',
             'is_pagination', 'is_heading', 'is_mode', 'is_zoom']
-    # create new dataframe based on usefulness
-    ddf_all = ddf.copy()
+    # requests matching more than one action (only computed when the diagnostics are requested)
+    if cooccurrence:
+        # Create a new column with the sum of all "is_" columns for each row
+        is_sum = ddf[['is_homepage', 'is_document', 'is_iiif', 'is_static_http', 'is_blog', 'is_zoom',
+                      'is_services', 'is_simple_search', 'is_advanced_search', 'is_filtering_search_results', 'is_pagination', 'is_heading', 'is_page_download', 'is_document_download', 'is_mode']].sum(axis=1)
+        ddf_plus = ddf.assign(is_sum=is_sum)
+        ddf_plus = ddf_plus.loc[ddf_plus["is_sum"] > 1, ['user', 'timestamp', 'endpoint', 'is_sum'] + actions]
+        # join the names of the matched actions with a vectorized dot product instead of a row-wise apply
+        ddf_plus["cooccurent"] = ddf_plus[actions].map_partitions(
+            lambda df: (df == 1).dot(pd.Index(actions) + ",").str.rstrip(","), meta=("cooccurent", "object"))
+        ddf_plus = ddf_plus.drop(actions, axis=1)
     # ddf_useful where column of actions are 1
     ddf = ddf.loc[(ddf[actions] == 1).any(axis=1)]
-    ddf_plus = ddf_all.loc[(ddf_all["is_sum"] > 1)]
-    ddf_0 = ddf_all.loc[(ddf_all["is_sum"] == 0)]
-
-    ddf_plus["cooccurent"] = ddf_plus[actions].apply(
-        lambda x: ",".join(x[x == 1].index), axis=1)
 
 
     # ### Document requests parsing
@@ -309,7 +325,7 @@ def process_chunk(start_index, stop_index, file_number):
 
     # create a list of columns we want to keep
     columns = ['user', 'user_agent', 'country', 'city', 'timestamp',
-            'Ark', 'action', 'doc_param', 'page_number', 'mode']
+            'Ark', 'action', 'doc_param', 'page_number', 'mode', 'row_key']
 
     # Drop the columns that are not needed anymore
     ddf = ddf[columns]
@@ -336,45 +352,84 @@ def process_chunk(start_index, stop_index, file_number):
 
     # ## III. Save to parquet
 
-    print(f"computing file {file_number}")
-    with ProgressBar():
-        result = ddf.compute()
-    print(f"file {file_number} computing done")
-
-    print(f"saving file {file_number}")
-    with ProgressBar():
-        # save to parquet
-        result.to_parquet("temp_data/processed_parquet/" + str(file_number) +
-                        ".parquet", engine="pyarrow", compression="snappy")
-    print(f"file {file_number} saving done")
+    output_path = PROCESSED_PARQUET + "/" + str(file_number) + ".parquet"
+    cooccurrence_path = COOCCURRENCE_PARQUET + "/" + str(file_number) + ".parquet"
+    remove_output(output_path)
+    if cooccurrence:
+        os.makedirs(COOCCURRENCE_PARQUET, exist_ok=True)
+        remove_output(cooccurrence_path)
+
+    # with a spill directory, run on a local cluster whose workers move partitions to disk under memory pressure
+    client = None
+    if spill_dir is not None:
+        from dask.distributed import Client
+        client = Client(processes=False, n_workers=1, threads_per_worker=os.cpu_count(),
+                        memory_limit=int(psutil.virtual_memory().available * 0.8), local_directory=spill_dir)
+
+    try:
+        if write_mode == "partitioned":
+            print(f"computing and saving file {file_number}")
+            # every partition is written by its own task, so the chunk never has to fit in memory
+            writes = [ddf.to_parquet(output_path, engine="pyarrow", compression="snappy",
+                                     write_index=False, compute=False)]
+            if cooccurrence:
+                writes.append(ddf_plus.to_parquet(cooccurrence_path, engine="pyarrow", compression="snappy",
+                                                  write_index=False, compute=False))
+            with ProgressBar():
+                # the outputs and counters share the same graph, so the common steps are computed once
+                *_, n_read, n_deduplicated = dask.compute(*writes, rows_read, rows_deduplicated)
+            print(f"file {file_number} saving done")
+        elif write_mode == "compute":
+            print(f"computing file {file_number}")
+            with ProgressBar():
+                if cooccurrence:
+                    result, cooccurrence_result, n_read, n_deduplicated = dask.compute(
+                        ddf, ddf_plus, rows_read, rows_deduplicated)
+                else:
+                    result, n_read, n_deduplicated = dask.compute(ddf, rows_read, rows_deduplicated)
+            print(f"file {file_number} computing done")
+
+            print(f"saving file {file_number}")
+            with ProgressBar():
+                # save to parquet
+                result.to_parquet(output_path, engine="pyarrow", compression="snappy")
+                if cooccurrence:
+                    cooccurrence_result.to_parquet(cooccurrence_path, engine="pyarrow", compression="snappy")
+            print(f"file {file_number} saving done")
+        else:
+            raise ValueError(f"unknown write mode {write_mode}")
+    finally:
+        if client is not None:
+            client.close()
+
+    update_dedup_stats(file_number, partition=n_read - n_deduplicated)
+    # recorded last, a chunk interrupted while writing is processed again
+    save_chunk_inputs(file_number, file_paths)
 
 # %%
-# get the file_numbers of the files in the processed_parquet folder
-# if the folder is empty, start from 0
-if len(os.listdir("temp_data/processed_parquet")) == 0:
-    last_file_number = 1
-else:
-    processed_files_numbers = [int(file.split(".")[0])
-                    for file in os.listdir("temp_data/processed_parquet")]
-    # get the number of the last file processed
-    last_file_number = max(processed_files_numbers)
-
-# process the files starting from the last file processed
-if last_file_number == 1:
-    restart_file_number = 1
-else:
-    restart_file_number = last_file_number + 1
-
-for  file_number in range(restart_file_number , len(files_start_indices) + 1):
-    # skip computing file 1300 and 1301
-    if file_number not in [1300, 1301]:
-        
+def process_all(write_mode=WRITE_MODE, cooccurrence=COOCCURRENCE, spill_dir=SPILL_DIR):
+    files_start_indices, files_stop_indices = chunk_indices()
+    os.makedirs(PROCESSED_PARQUET, exist_ok=True)
+    local_paths = pd.read_csv(FILES_CSV)['local_path'].tolist()
+
+    for  file_number in range(1, len(files_start_indices) + 1):
+        # skip computing file 1300 and 1301
+        if file_number in SKIPPED_FILE_NUMBERS:
+            print(f"file {file_number} skipped")
+            continue
+        start_index = files_start_indices[file_number - 1]
+        stop_index = files_stop_indices[file_number - 1]
+        # chunks that point past the end of the file list have nothing to process yet
+        if start_index >= len(local_paths):
+            break
+        # a chunk is processed again when its files changed, e.g. when new files completed the last chunk
+        output_path = PROCESSED_PARQUET + "/" + str(file_number) + ".parquet"
+        if os.path.exists(output_path) and load_chunk_inputs(file_number) == chunk_inputs(local_paths[start_index:stop_index]):
+            continue
+
         print(f"processing file {file_number}")
         # process chunck
-        print(f"start at index {files_start_indices[file_number - 1]}")
-        print(f"stop at index {files_stop_indices[file_number - 1]}")
-        process_chunk(files_start_indices[file_number - 1], files_stop_indices[file_number - 1], file_number)
-    else:
-        print(f"file {file_number} skipped")
-
-print("Done")
+        print(f"start at index {start_index}")
+        print(f"stop at index {stop_index}")
+        process_chunk(start_index, stop_index, file_number,
+                      write_mode=write_mode, cooccurrence=cooccurrence, spill_dir=spill_dir)
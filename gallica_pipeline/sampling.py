@@ -0,0 +1,30 @@
+# %%
+import hashlib
+import pandas as pd
+from .config import SAMPLE_FRACTION, SAMPLE_SALT, SAMPLE_BUCKETS
+
+# %% [markdown]
+# ## Reproducible user sampling
+#
+# Every stage keeps the same users: a user is in the sample when the hash of its id falls in the first
+# SAMPLE_FRACTION of the hash buckets. Whole users (and therefore whole sessions) are kept, and a smaller
+# sample is always a subset of a larger one. The fraction is read from the environment so the commands
+# and the notebooks of one run all agree on it, e.g. `python -m gallica_pipeline --sample 0.01 run`.
+
+# %%
+# pandas hashes with a key of exactly 16 bytes, derived from the salt so any salt can be used
+HASH_KEY = hashlib.md5(SAMPLE_SALT.encode()).hexdigest()[:16]
+
+
+def user_in_sample(users, fraction=None):
+    # return a boolean series marking the users kept in the sample
+    fraction = SAMPLE_FRACTION if fraction is None else fraction
+    if fraction >= 1:
+        return pd.Series(True, index=users.index)
+    hashes = pd.util.hash_pandas_object(users.astype(object), index=False, hash_key=HASH_KEY)
+    return (hashes % SAMPLE_BUCKETS) < round(fraction * SAMPLE_BUCKETS)
+
+
+def session_in_sample(session_ids, fraction=None):
+    # session ids end with "_U_<user>", which lets the notebooks apply the same rule to the sessions
+    return user_in_sample(session_ids.str.split("_U_", n=1).str[1], fraction)
@@ -0,0 +1,477 @@
+# %%
+import pandas as pd
+import numpy as np
+import json
+import os
+from .config import (INACTIVE_THRESHOLD, REQUEST_THRESHOLD, IS_BOT, SESSIONS_ROW_GROUP_SIZE, PROCESSED_PARQUET,
+                     SESSIONS_PARQUET, SESSIONS_STATE)
+from .sampling import user_in_sample
+from .dedup import drop_chunk_duplicates, drop_window_duplicates, update_dedup_stats
+from .dag import INCREMENTAL_KEY, load_manifest, save_manifest, load_chunk_inputs
+# deactivating warnings
+import warnings
+
+# %% [markdown]
+# ## I. Read preprocessed data
+
+# %%
+def read_chunk(file_number):
+    # read data
+    df = pd.read_parquet(PROCESSED_PARQUET + "/" + str(file_number) + ".parquet", engine="pyarrow")
+
+    # keep the users of the sample (no-op outside of sampling mode)
+    df = df[user_in_sample(df["user"])]
+
+    # Convert the timestamp column to a datetime data type, and set it as the index
+    df["timestamp"] = pd.to_datetime(
+        df["timestamp"], format="%d/%b/%Y:%H:%M:%S %z")
+
+    # drop the duplicates across the partitions of the chunk and with the end of the previous chunk
+    n_rows = len(df)
+    df = drop_chunk_duplicates(df)
+    n_chunk_dropped = n_rows - len(df)
+
+    previous_df = None
+    previous_path = PROCESSED_PARQUET + "/" + str(file_number - 1) + ".parquet"
+    if os.path.exists(previous_path):
+        # only the two columns needed to compare the keys are read
+        previous_df = pd.read_parquet(previous_path, engine="pyarrow", columns=["timestamp", "row_key"])
+        previous_df["timestamp"] = pd.to_datetime(
+            previous_df["timestamp"], format="%d/%b/%Y:%H:%M:%S %z")
+    n_rows = len(df)
+    df = drop_window_duplicates(df, previous_df)
+    update_dedup_stats(file_number, chunk=n_chunk_dropped, window=n_rows - len(df))
+
+    if IS_BOT:
+        df = df[df["is_bot"] == 1]
+    else:
+        df = df[df["is_bot"] == 0]
+
+    df = df.drop(columns=["is_bot"]).reset_index(drop=True)
+
+    df['doc_param'] = df['doc_param'].fillna('No_param')
+
+    return df
+
+
+# %% [markdown]
+# ## II. Detect sessions
+
+# %%
+def detect_sessions(df, file_number, tail=None):
+    # tail: state of the users at the end of the previous data (see update_sessions), indexed by user
+    # Sort the DataFrame by user ID and timestamp
+    df.sort_values(["user", "timestamp"], inplace=True)
+
+    # filter users with less than 5 requests in total (known users were admitted with their previous requests)
+    is_known = df["user"].isin(tail.index) if tail is not None else False
+    df = df[(df.groupby("user")["user"].transform("size") >= 5) | is_known]
+
+    # Calculate the time difference between consecutive log entries for each user ID
+    df["time_diff"] = df.groupby("user")["timestamp"].diff()
+
+    # Set a threshold for determining the start of a new session (e.g., 30 minutes)
+    threshold = pd.Timedelta(minutes=INACTIVE_THRESHOLD)
+
+    # Identify the first ever request by each user
+    df["first_request"] = df.groupby("user").cumcount() == 0
+
+    # the sessions of known users are numbered after the session open at the end of the previous data
+    df["session_offset"] = 0
+    if tail is not None:
+        # the first request of a known user follows its last request of the previous data
+        first_known = df["first_request"] & df["user"].isin(tail.index)
+        df.loc[first_known, "time_diff"] = df.loc[first_known, "timestamp"] - \
+            df.loc[first_known, "user"].map(tail["last_timestamp"])
+        df["session_offset"] = df["user"].map(tail["session_number"]).fillna(0).astype(int)
+
+    # Determine the start of each session (the first request of a known user may continue its open session)
+    df["session_start"] = (df["first_request"] & df["time_diff"].isna()) | (df["time_diff"] > threshold)
+
+    # Drop the first_request column
+    df.drop("first_request", axis=1, inplace=True)
+
+    # Calculate the session number for each user
+    df["session_number"] = df.groupby("user")["session_start"].cumsum() + df["session_offset"]
+
+    # calculate the position of each request in the session
+    df["request_position_in_session"] = df.groupby(
+        ["user", "session_number"]).cumcount() + 1
+
+
+    # ## III. Remove sessions with very frequent requests (Non human behavior)
+
+
+
+    # Combine groupby operations and use agg() function to calculate aggregated values in a single pass
+    aggregated_data = df.groupby(["user", "session_number"]).agg(
+        request_count=("request_position_in_session", "count"),
+        total_time=(
+            "time_diff", lambda x: x[x.index[0] != x.index].sum().total_seconds())
+    )
+
+    # Calculate request frequencies
+    aggregated_data["request_frequency_in_session"] = aggregated_data["request_count"] / \
+        aggregated_data["total_time"]
+    aggregated_data["request_frequency_global"] = aggregated_data.groupby(
+        "user")["request_frequency_in_session"].transform("mean")
+
+    # Mark users with request_frequency_global > REQUEST_THRESHOLD
+    aggregated_data["is_marked"] = aggregated_data["request_frequency_global"] > REQUEST_THRESHOLD
+
+    # Merge the is_marked column back to the original DataFrame
+    df = df.merge(aggregated_data["is_marked"], left_on=[
+                "user", "session_number"], right_index=True)
+
+    # Filter marked and unmarked users
+    df = df.query("is_marked == False").drop("is_marked", axis=1)
+
+
+    # ## IV. Recompute sessions
+
+
+    # recompute the session number for each user
+    df["session_number"] = df.groupby("user")["session_start"].cumsum() + df["session_offset"]
+    df.drop("session_offset", axis=1, inplace=True)
+
+    # recompute the position of each request in the session
+    df["request_position_in_session"] = df.groupby(
+        ["user", "session_number"]).cumcount() + 1
+
+    # Generate a user-friendly session ID
+    df["session_id"] = (
+        "S_"
+        + str(file_number)
+        + "_"
+        + df["session_number"].astype(str)
+        + "_U_"
+        + df["user"].astype(str)
+    )
+
+    if tail is not None:
+        # a continued session keeps its id, and its requests are positioned after those of the previous data
+        continued = df["session_number"] == df["user"].map(tail["session_number"])
+        df.loc[continued, "session_id"] = df.loc[continued, "user"].map(tail["session_id"])
+        df.loc[continued, "request_position_in_session"] += df.loc[continued, "user"].map(
+            tail["request_position"]).astype(int)
+
+    # Generate a user-friendly request ID
+    df["request_id"] = (
+        "S_"
+        + df["session_number"].astype(str)
+        + "_"
+        + df["request_position_in_session"].astype(str)
+        + "_U_"
+        + df["user"].astype(str)
+    )
+
+    # sort by user than by session number than by session position
+    df.sort_values(["user", "session_number",
+                "request_position_in_session"], inplace=True)
+
+    # mark the end of each session (should be true for the last request of each session and false for the rest)
+    df["session_end"] = df.groupby(["user", "session_number"])[
+        "request_position_in_session"].transform("max") == df["request_position_in_session"]
+
+    # Convert time difference to seconds
+    df["time_diff"] = df["time_diff"].apply(lambda x: x.total_seconds())
+
+    return df
+
+
+# %% [markdown]
+# ## V. Action tree
+
+# %%
+def build_action_tree(df, tail_docs=None):
+    # tail_docs: documents of the sessions still open at the end of the previous data (see update_sessions).
+    # returns the dataframe and, when tail_docs is given, the last page of every document of every session
+
+
+    # ### Index documents and document pages in sessions
+
+
+    df['page_number'] = df['page_number'].fillna(-999).astype(int)
+
+    # filter rows where action is pagination and no page number is provided
+    df = df[~((df["action"] == "is_pagination") & (df["page_number"] == -999))]
+
+    if tail_docs is not None:
+        # put the documents of the continued sessions first (in the order of their numbers, with their last page)
+        # so the numbering and the previous pages below carry on from the previous data
+        anchors = tail_docs[tail_docs["session_id"].isin(df["session_id"])].sort_values(
+            ["session_id", "doc_number_in_session"])
+        anchors = anchors[["session_id", "Ark", "page_number"]].assign(is_anchor=True)
+        dtypes = df.dtypes.to_dict()
+        df = pd.concat([anchors, df.assign(is_anchor=False)], ignore_index=True)
+
+    # compute the document number in the session
+    df['doc_number_in_session'] = df.groupby('session_id')['Ark'].transform(
+        lambda x: x.dropna().map(dict(zip(x.dropna().unique(), range(1, len(x.dropna().unique())+1)))))
+    df['doc_number_in_session'] = df['doc_number_in_session'].fillna(
+        -999).astype(int)
+
+    # in each session, in each row compute the previous page in the same document (if exists)
+    df['prev_page_in_doc'] = df.groupby(['session_id', 'doc_number_in_session'])[
+        'page_number'].shift(1)
+    df.loc[(df['action'] != 'is_document') & (df['action']
+                                            != 'is_pagination'), 'prev_page_in_doc'] = np.nan
+    df['prev_page_in_doc'] = df['prev_page_in_doc'].fillna(-999).astype(int)
+
+    docs = None
+    if tail_docs is not None:
+        # last page of every document of every session, to continue the sessions with the next data
+        docs = df.groupby(["session_id", "doc_number_in_session"]).agg(
+            Ark=("Ark", "first"), page_number=("page_number", "last")).reset_index()
+        # the anchors had missing values in the other columns, restore their types
+        df = df[~df["is_anchor"]].drop("is_anchor", axis=1).astype(dtypes)
+
+    # filter the rows where the page number and the previous page in the same document are the same and not -999
+    df = df.loc[(df['page_number'] != df['prev_page_in_doc']) | (
+        df['page_number'] == -999) & (df['prev_page_in_doc'] == -999)]
+
+
+    # is document acess if the action is is_document and the previous page is -999
+    df['is_document_access'] = (df['action'] == 'is_document') & (
+        df['prev_page_in_doc'] == -999).astype(int)
+
+    # is homepage if the action is is_homepage
+    df['is_homepage'] = (df['action'] == 'is_homepage').astype(int)
+
+    # is heading if the action is is_heading
+    df['is_heading_navigation'] = (df['action'] == 'is_heading').astype(int)
+
+    # is blog if the action is is_blog
+    df['is_blog_navigation'] = (df['action'] == 'is_blog').astype(int)
+
+    # is first page if the previous page is -999 and the page number is different from -999
+    df['is_first_page'] = (df['prev_page_in_doc'] == -
+                        999) & (df['page_number'] != -999) & (df['is_document_access'] == False).astype(int)
+    # is next page if the page number is the previous page + 1 or + 2 (for the case of double page)
+    df['is_next_page'] = (df['page_number'] == df['prev_page_in_doc'] +
+                        1) | (df['page_number'] == df['prev_page_in_doc'] + 2).astype(int)
+    # is prev page if the page number is the previous page - 1 or - 2 (for the case of double page)
+    df['is_prev_page'] = (df['page_number'] == df['prev_page_in_doc'] -
+                        1) | (df['page_number'] == df['prev_page_in_doc'] - 2).astype(int)
+    # is chosen page if the page number is different from -999 and the previous page is different from -999 and the difference betweem them is greater than 2
+    df['is_chosen_page'] = (df['page_number'] != -999) & (df['prev_page_in_doc']
+                                                        != -999) & (abs(df['page_number'] - df['prev_page_in_doc']) > 2).astype(int)
+    df['is_revisit_document'] = (df['action'] == 'is_document') & (
+        df['page_number'] == -999) & (df['prev_page_in_doc'] != -999).astype(int)
+
+
+    # is to single page mode if mode is single
+    df['is_to_single_page_mode'] = (
+        df['mode'] == 'SINGLE').fillna(False).astype(int)
+    # is to double page mode if mode is double
+    df['is_to_double_page_mode'] = (
+        df['mode'] == 'DOUBLE').fillna(False).astype(int)
+    # is to multi page mode if mode is multi
+    df['is_to_multi_page_mode'] = (df['mode'] == 'MULTI').fillna(False).astype(int)
+    # is to vertical page mode if mode is vertical
+    df['is_to_vertical_page_mode'] = (
+        df['mode'] == 'VERTICAL').fillna(False).astype(int)
+    # is to audio page mode if mode is audio
+    df['is_to_audio_page_mode'] = ((df['mode'] == 'AUDIO') | (df['mode'] == 'TEXT_RAW') | (df['mode'] == 'MEDIA') | (df['mode'] == 'D3')).fillna(False).astype(int)
+    # is zoom  if the action is is_zoom
+    df['is_zoom'] = ((df['action'] == 'is_zoom') | (df['mode'] == 'ZOOM')).fillna(False).astype(int)
+
+    # is simple search if the action is is_simple_search
+    df['is_simple_search'] = (df['action'] == 'is_simple_search').astype(int)
+    # is advanced search if the action is is_advanced_search
+    df['is_advanced_search'] = (df['action'] == 'is_advanced_search').astype(int)
+    # is filtering search results if the action is is_filtering_search_results
+    df['is_filtering_search_results'] = (
+        df['action'] == 'is_filtering_search_results').astype(int)
+
+    # is document download if the action is is_document_download
+    df['is_document_download'] = (
+        df['action'] == 'is_document_download').astype(int)
+    # is page download if the action is is_page_download
+    df['is_page_download'] = (df['action'] == 'is_page_download').astype(int)
+
+
+    precise_actions = ['is_document_access', 'is_homepage', 'is_heading_navigation', 'is_blog_navigation', 'is_first_page', 'is_next_page', 'is_prev_page', 'is_chosen_page', 'is_revisit_document', 'is_to_single_page_mode', 'is_to_double_page_mode',
+                    'is_to_multi_page_mode', 'is_to_vertical_page_mode', 'is_to_audio_page_mode', 'is_zoom', 'is_simple_search', 'is_advanced_search', 'is_filtering_search_results', 'is_document_download', 'is_page_download']
+
+    df['is_sum'] = df[precise_actions].sum(axis=1)
+
+    # make sure that no request has more than one action
+    if df[df['is_sum'] > 1].shape[0] != 0:
+        # print the requests that have more than one action
+        print(df[df['is_sum'] > 1].shape)
+        print(df.loc[df['is_sum'] > 1, ['request_id', 'action', 'mode']])
+        # raise an error
+        raise AssertionError("There are requests that have more than one action")
+    assert df[df['is_sum'] > 1].shape[0] == 0
+    
+    # make sure that no request has no action
+    if df[df['is_sum'] < 1].shape[0] != 0:
+        # print the requests that have no action
+        print(df.loc[df['is_sum'] < 1, ['request_id', 'action', 'mode']])
+        # raise an error
+        raise AssertionError("There are requests that have no action")
+    assert df[df['is_sum'] < 1].shape[0] == 0
+
+    # precise request
+    df["precise_action"] = df[precise_actions].astype(int).idxmax(axis=1)
+    # remove the is in the name of the action
+    df["precise_action"] = df["precise_action"].str.replace("is_", "")
+
+    return df, docs
+
+
+# %% [markdown]
+# ## VI. Save the sessions
+
+# %%
+def save_sessions(df, file_number):
+    # ### Build sessions as sequences of actions
+
+
+    # build the sessions as sequences of actions including the timestamp of the action (rename the column to be more clear)
+    sessions = df[['session_id', 'precise_action', 'timestamp', 'Ark']]
+    sessions = sessions.rename(columns={'precise_action': 'action'})
+
+
+    # Save as Parquet
+    if ~IS_BOT:
+        sessions.to_parquet(SESSIONS_PARQUET + "/sessions_" + str(file_number) +
+                            ".parquet", engine="pyarrow", index=False, compression="snappy",
+                            row_group_size=SESSIONS_ROW_GROUP_SIZE)
+        print("Saved sessions_" + str(file_number) + ".parquet")
+
+
+def form_sessions(file_number):
+    warnings.filterwarnings("ignore")
+    os.makedirs(SESSIONS_PARQUET, exist_ok=True)
+
+    df = read_chunk(file_number)
+    df = detect_sessions(df, file_number)
+    df, _ = build_action_tree(df)
+
+    save_sessions(df, file_number)
+
+
+def form_all_sessions():
+    os.makedirs(SESSIONS_PARQUET, exist_ok=True)
+
+    processed_files_numbers = sorted(int(file.split(".")[0]) for file in os.listdir(PROCESSED_PARQUET))
+    for file_number in processed_files_numbers:
+        # form the sessions of the chunks not formed yet, and of the chunks processed again since
+        # (e.g. the last chunk once new files completed it)
+        processed_path = PROCESSED_PARQUET + "/" + str(file_number) + ".parquet"
+        sessions_path = SESSIONS_PARQUET + "/sessions_" + str(file_number) + ".parquet"
+        if not os.path.exists(sessions_path) or os.path.getmtime(sessions_path) < os.path.getmtime(processed_path):
+            form_sessions(file_number)
+
+
+# %% [markdown]
+# ## VII. Incremental sessions
+#
+# Instead of forming the sessions of every chunk from scratch, the chunks can be consumed in order while the
+# state of every user at the end of the data is persisted: its last request, its open session (number, id,
+# position of the last request) and the documents of that session with their last page (for the action tree).
+# The sessions of a new chunk then extend the open sessions of the users or start new ones. Only the sessions
+# partition of the new chunk is written: a continued session keeps its id and its new requests are stored in
+# the new partition, so the cost of an update is proportional to the new data.
+
+# %%
+def load_state():
+    # last chunk consumed, the chunk consumed before it and the inputs the last chunk was processed from
+    state_path = SESSIONS_STATE + "/state.json"
+    if not os.path.exists(state_path):
+        return {"last_file_number": 0, "previous_file_number": 0, "last_inputs": None}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def load_tail_state(file_number):
+    # return the tail of the users and the documents of their open sessions after the chunk was consumed
+    if file_number == 0:
+        tail = pd.DataFrame({
+            "last_timestamp": pd.Series(dtype="datetime64[ns, UTC]"),
+            "session_number": pd.Series(dtype="int64"),
+            "session_id": pd.Series(dtype="object"),
+            "request_position": pd.Series(dtype="int64"),
+        }, index=pd.Index([], name="user"))
+        tail_docs = pd.DataFrame({
+            "session_id": pd.Series(dtype="object"),
+            "doc_number_in_session": pd.Series(dtype="int64"),
+            "Ark": pd.Series(dtype="object"),
+            "page_number": pd.Series(dtype="int64"),
+        })
+        return tail, tail_docs
+
+    tail = pd.read_parquet(SESSIONS_STATE + "/tail_" + str(file_number) + ".parquet").set_index("user")
+    tail_docs = pd.read_parquet(SESSIONS_STATE + "/tail_docs_" + str(file_number) + ".parquet")
+    return tail, tail_docs
+
+
+def save_tail_state(tail, tail_docs, file_number, previous_file_number):
+    os.makedirs(SESSIONS_STATE, exist_ok=True)
+    tail.reset_index().to_parquet(SESSIONS_STATE + "/tail_" + str(file_number) + ".parquet", index=False)
+    tail_docs.to_parquet(SESSIONS_STATE + "/tail_docs_" + str(file_number) + ".parquet", index=False)
+
+    # state.json is replaced last, so an interrupted update leaves the previous state untouched
+    state = {"last_file_number": file_number, "previous_file_number": previous_file_number,
+             "last_inputs": load_chunk_inputs(file_number)}
+    with open(SESSIONS_STATE + "/state.json.tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(SESSIONS_STATE + "/state.json.tmp", SESSIONS_STATE + "/state.json")
+
+    # remove the state of the older chunks, the previous one is kept in case the last chunk is processed again
+    kept = ("_" + str(file_number) + ".parquet", "_" + str(previous_file_number) + ".parquet")
+    for file in os.listdir(SESSIONS_STATE):
+        if file.startswith("tail") and not file.endswith(kept):
+            os.remove(SESSIONS_STATE + "/" + file)
+
+
+def update_sessions(file_number, tail, tail_docs):
+    warnings.filterwarnings("ignore")
+    os.makedirs(SESSIONS_PARQUET, exist_ok=True)
+
+    df = read_chunk(file_number)
+    chunk_end = df["timestamp"].max()
+    df = detect_sessions(df, file_number, tail)
+
+    # last request of every user of the chunk, which is also the end of its open session
+    new_tail = df.groupby("user").tail(1).set_index("user")
+    new_tail = new_tail[["timestamp", "session_number", "session_id", "request_position_in_session"]].rename(
+        columns={"timestamp": "last_timestamp", "request_position_in_session": "request_position"})
+    new_tail["last_timestamp"] = pd.to_datetime(new_tail["last_timestamp"], utc=True)
+
+    df, docs = build_action_tree(df, tail_docs)
+    save_sessions(df, file_number)
+
+    # users absent from the chunk keep their state, until they have been inactive for longer than the threshold
+    tail = pd.concat([tail[~tail.index.isin(new_tail.index)], new_tail])
+    tail = tail[tail["last_timestamp"] >= chunk_end - pd.Timedelta(minutes=INACTIVE_THRESHOLD)]
+
+    # keep the documents of the open sessions only
+    tail_docs = pd.concat([tail_docs, docs]).drop_duplicates(
+        ["session_id", "doc_number_in_session"], keep="last")
+    tail_docs = tail_docs[tail_docs["session_id"].isin(tail["session_id"])]
+    return tail, tail_docs
+
+
+def update_all_sessions():
+    # consume the processed chunks that were not consumed yet, in order
+    state = load_state()
+    last_file_number = state["last_file_number"]
+    # the last chunk consumed may have been processed again since, e.g. when new files completed it:
+    # its sessions are formed again from the state left by the chunk before it
+    if last_file_number and load_chunk_inputs(last_file_number) != state["last_inputs"]:
+        last_file_number = state["previous_file_number"]
+    tail, tail_docs = load_tail_state(last_file_number)
+
+    processed_files_numbers = sorted(int(file.split(".")[0]) for file in os.listdir(PROCESSED_PARQUET))
+    for file_number in processed_files_numbers:
+        if file_number > last_file_number:
+            tail, tail_docs = update_sessions(file_number, tail, tail_docs)
+            save_tail_state(tail, tail_docs, file_number, last_file_number)
+            last_file_number = file_number
+            # the partition no longer matches the key of the DAG task that writes it, so `status` reports it
+            manifest = load_manifest()
+            manifest[SESSIONS_PARQUET + "/sessions_" + str(file_number) + ".parquet"] = INCREMENTAL_KEY
+            save_manifest(manifest)